@@ -8,17 +8,19 @@ Features:
 - /leaderboard (top 10, resets weekly on Monday UTC)
 - /balance to check your coins
 - Anti-cheat: rate limiting, input validation, duplicate bet prevention
-- Thread-safe SQLite with WAL mode
+- Pooled SQLite: one writer + concurrent WAL readers
+- Serves the Mini App API (server.py) from the same process and DB pool
 - Graceful CoinGecko API error handling
 """
 
-import sqlite3
-import requests
+import asyncio
 import logging
+import os
 import threading
-from datetime import datetime, timedelta, timezone
-from collections import defaultdict
-from apscheduler.schedulers.background import BackgroundScheduler
+import time
+from collections import deque
+from datetime import datetime, timezone
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
@@ -27,6 +29,26 @@ from telegram.ext import (
     ContextTypes,
 )
 
+from waitress import serve
+
+from db import (
+    READ_POOL_SIZE,
+    compute_ranks,
+    current_week_start,
+    get_cached_open_market,
+    get_open_market,
+    init_db,
+    invalidate_leaderboard,
+    invalidate_open_market,
+    load_leaderboard,
+    place_bet_atomic,
+    pool,
+    publish_ranks,
+    upsert_user,
+)
+from prices import get_btc_price
+from server import app as api_app
+
 # ─── CONFIG ───────────────────────────────────────────────────────────────────
 
 TOKEN = "REPLACE WITH TOKEN\!"
@@ -50,162 +72,108 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
-# ─── DATABASE ─────────────────────────────────────────────────────────────────
-
-_db_lock = threading.Lock()
-
-def get_conn():
-    """Return a thread-local WAL-mode SQLite connection."""
-    conn = sqlite3.connect("coinpredict.db", check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    with get_conn() as conn:
-        conn.executescript("""
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id   INTEGER PRIMARY KEY,
-                username      TEXT,
-                coins         INTEGER NOT NULL DEFAULT 0,
-                last_daily    TEXT    -- ISO date YYYY-MM-DD UTC
-            );
-
-            CREATE TABLE IF NOT EXISTS markets (
-                id            INTEGER PRIMARY KEY AUTOINCREMENT,
-                open_price    REAL    NOT NULL,
-                close_price   REAL,
-                open_time     TEXT    NOT NULL,
-                close_time    TEXT,
-                status        TEXT    NOT NULL DEFAULT 'OPEN'  -- OPEN | CLOSED
-            );
-
-            CREATE TABLE IF NOT EXISTS bets (
-                id            INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id       INTEGER NOT NULL REFERENCES users(telegram_id),
-                market_id     INTEGER NOT NULL REFERENCES markets(id),
-                direction     TEXT    NOT NULL,  -- UP | DOWN
-                amount        INTEGER NOT NULL,
-                resolved      INTEGER NOT NULL DEFAULT 0,
-                UNIQUE(user_id, market_id)       -- one bet per user per market
-            );
-
-            -- Weekly leaderboard snapshots (for display; actual coins never reset)
-            CREATE TABLE IF NOT EXISTS weekly_coins_snapshot (
-                user_id       INTEGER PRIMARY KEY REFERENCES users(telegram_id),
-                coins_at_week_start INTEGER NOT NULL DEFAULT 0,
-                week_start    TEXT    NOT NULL  -- ISO date of Monday
-            );
-        """)
-    log.info("Database initialised.")
-
-# ─── PRICE FETCHER ────────────────────────────────────────────────────────────
-
-COINGECKO_URL = (
-    "https://api.coingecko.com/api/v3/simple/price"
-    "?ids=bitcoin&vs_currencies=usd"
-)
-
-def get_btc_price() -> float | None:
-    """Fetch BTC/USD from CoinGecko. Returns None on failure."""
-    try:
-        resp = requests.get(COINGECKO_URL, timeout=10)
-        resp.raise_for_status()
-        price = resp.json()["bitcoin"]["usd"]
-        log.info(f"BTC price fetched: ${price:,.2f}")
-        return float(price)
-    except Exception as e:
-        log.error(f"CoinGecko error: {e}")
-        return None
-
 # ─── MARKET ENGINE ────────────────────────────────────────────────────────────
 
-def get_open_market(conn):
-    return conn.execute(
-        "SELECT * FROM markets WHERE status='OPEN' ORDER BY id DESC LIMIT 1"
-    ).fetchone()
-
-def open_new_market(conn):
-    price = get_btc_price()
+def open_new_market(conn, price: float | None):
+    """Insert a new OPEN market at `price` (fetched by the caller, outside the writer)."""
     if price is None:
         log.warning("Could not open new market: price unavailable.")
         return
-    now       = datetime.now(timezone.utc)
-    close_at  = (now + timedelta(minutes=MARKET_INTERVAL_MINS)).isoformat()
+    now       = int(time.time())
+    close_at  = now + MARKET_INTERVAL_MINS * 60
     conn.execute(
         "INSERT INTO markets (open_price, open_time, close_time, status) VALUES (?,?,?,'OPEN')",
-        (price, now.isoformat(), close_at),
+        (price, now, close_at),
     )
-    log.info(f"New market opened at ${price:,.2f}, closes at {close_at}")
+    log.info(
+        f"New market opened at ${price:,.2f}, closes at "
+        f"{time.strftime('%H:%M:%S UTC', time.gmtime(close_at))}"
+    )
+
+def _settle_market(conn, market, close_price: float):
+    """Close `market` at `close_price` and credit winners (or refund on tie)."""
+    market_id  = market["id"]
+    open_price = market["open_price"]
+    now        = int(time.time())
+    is_tie     = abs(close_price - open_price) < 0.01   # price unchanged
+
+    conn.execute(
+        "UPDATE markets SET close_price=?, close_time=?, status='CLOSED' WHERE id=?",
+        (close_price, now, market_id),
+    )
+
+    # One set-based UPDATE credits every payee (one bet per user per market)
+    direction  = None if is_tie else ("UP" if close_price > open_price else "DOWN")
+    multiplier = 1 if is_tie else WIN_MULTIPLIER
+    paid = conn.execute(
+        """
+        UPDATE users
+        SET coins = coins + (
+            SELECT b.amount * ? FROM bets b
+            WHERE b.user_id = users.telegram_id AND b.market_id = ? AND b.resolved = 0
+        )
+        WHERE telegram_id IN (
+            SELECT user_id FROM bets
+            WHERE market_id = ? AND resolved = 0 AND (? OR direction = ?)
+        )
+        """,
+        (multiplier, market_id, market_id, is_tie, direction),
+    ).rowcount
+    total = conn.execute(
+        """
+        UPDATE bets
+        SET resolved = 1,
+            outcome  = CASE WHEN ? THEN 'TIE' WHEN direction = ? THEN 'WIN' ELSE 'LOSS' END
+        WHERE market_id = ? AND resolved = 0
+        """,
+        (is_tie, direction, market_id),
+    ).rowcount
+
+    if is_tie:
+        # ── TIE: every bettor got their stake back ──
+        log.info(f"Market {market_id} TIED at ${close_price:,.2f}. {paid} bets refunded.")
+    else:
+        # ── WIN/LOSS: winners got 2× ──
+        log.info(
+            f"Market {market_id}: ${open_price:,.2f}→${close_price:,.2f} ({direction}). "
+            f"{paid}/{total} bets won."
+        )
 
-def resolve_market():
+def _do_resolve_market():
     """Close the open market, pay winners (or refund on tie), open a new one."""
-    close_price = get_btc_price()
+    close_price = get_btc_price(force=True)
     if close_price is None:
         log.warning("Skipping market resolution: price unavailable.")
         return
 
-    with _db_lock, get_conn() as conn:
+    # Whole resolution is one transaction (one commit/fsync) with no network I/O
+    # inside it: the close price doubles as the next market's open price.
+    with pool.write() as conn:
+        # Take the write lock upfront: no read→write upgrade mid-resolution
+        conn.execute("BEGIN IMMEDIATE")
         market = get_open_market(conn)
-        if not market:
-            log.info("No open market to resolve; opening one.")
-            open_new_market(conn)
-            return
-
-        market_id  = market["id"]
-        open_price = market["open_price"]
-        now        = datetime.now(timezone.utc).isoformat()
-        is_tie     = abs(close_price - open_price) < 0.01   # price unchanged
-
-        conn.execute(
-            "UPDATE markets SET close_price=?, close_time=?, status='CLOSED' WHERE id=?",
-            (close_price, now, market_id),
-        )
-
-        all_bets = conn.execute(
-            "SELECT user_id, amount, direction FROM bets "
-            "WHERE market_id=? AND resolved=0",
-            (market_id,),
-        ).fetchall()
-
-        if is_tie:
-            # ── TIE: refund every bettor their stake ──
-            for row in all_bets:
-                conn.execute(
-                    "UPDATE users SET coins = coins + ? WHERE telegram_id=?",
-                    (row["amount"], row["user_id"]),
-                )
-            log.info(f"Market {market_id} TIED at ${close_price:,.2f}. {len(all_bets)} bets refunded.")
+        if market:
+            _settle_market(conn, market, close_price)
         else:
-            # ── WIN/LOSS: pay winners 2× ──
-            direction = "UP" if close_price > open_price else "DOWN"
-            winners = [r for r in all_bets if r["direction"] == direction]
-            for row in winners:
-                conn.execute(
-                    "UPDATE users SET coins = coins + ? WHERE telegram_id=?",
-                    (row["amount"] * WIN_MULTIPLIER, row["user_id"]),
-                )
-            log.info(
-                f"Market {market_id}: ${open_price:,.2f}→${close_price:,.2f} ({direction}). "
-                f"{len(winners)}/{len(all_bets)} bets won."
-            )
-
-        conn.execute("UPDATE bets SET resolved=1 WHERE market_id=?", (market_id,))
-        open_new_market(conn)
+            log.info("No open market to resolve; opening one.")
+        ranks = compute_ranks(conn)
+        open_new_market(conn, close_price)
+    # Publish/drop caches only once the commit is visible: doing it inside the
+    # transaction lets readers see (or re-cache) state that may yet roll back.
+    publish_ranks(ranks)
+    invalidate_open_market()
+    invalidate_leaderboard()  # payouts moved the standings
+
+async def resolve_market():
+    # Scheduled on the bot's event loop; the blocking work runs on a worker thread
+    await asyncio.to_thread(_do_resolve_market)
 
 # ─── WEEKLY LEADERBOARD RESET ─────────────────────────────────────────────────
 
-def _current_week_start() -> str:
-    """Return ISO date string of the most recent Monday (UTC)."""
-    today = datetime.now(timezone.utc).date()
-    monday = today - timedelta(days=today.weekday())
-    return monday.isoformat()
-
 def refresh_weekly_snapshot():
     """Run every Monday at midnight UTC: snapshot current coin balances."""
-    week_start = _current_week_start()
-    with _db_lock, get_conn() as conn:
+    week_start = current_week_start()
+    with pool.write() as conn:
         conn.execute("DELETE FROM weekly_coins_snapshot")
         conn.execute(
             """
@@ -214,45 +182,89 @@ def refresh_weekly_snapshot():
             """,
             (week_start,),
         )
+    # A /leaderboard that raced the rollover cached the new week without
+    # snapshot rows (full balances as weekly gain); drop it after the commit.
+    invalidate_leaderboard()
     log.info(f"Weekly leaderboard snapshot refreshed for week of {week_start}.")
 
 # ─── RATE LIMITER ─────────────────────────────────────────────────────────────
 
-_rate_buckets: dict[int, list[float]] = defaultdict(list)
+# Sliding window per user: timestamps of their bets in the last window, oldest
+# first, so expired entries pop off the left in O(1) each.
+_rate_buckets: dict[int, deque[float]] = {}
 _rate_lock = threading.Lock()
 
 def is_rate_limited(user_id: int) -> bool:
     """True if the user has exceeded BET_RATE_LIMIT_COUNT in the last window."""
-    now = datetime.now(timezone.utc).timestamp()
+    now = time.monotonic()
     cutoff = now - BET_RATE_LIMIT_WINDOW
     with _rate_lock:
-        bucket = _rate_buckets[user_id]
-        # Prune old entries
-        _rate_buckets[user_id] = [t for t in bucket if t > cutoff]
-        if len(_rate_buckets[user_id]) >= BET_RATE_LIMIT_COUNT:
+        bucket = _rate_buckets.setdefault(user_id, deque())
+        while bucket and bucket[0] <= cutoff:
+            bucket.popleft()
+        if len(bucket) >= BET_RATE_LIMIT_COUNT:
             return True
-        _rate_buckets[user_id].append(now)
+        bucket.append(now)
         return False
 
+def _gc_rate_buckets():
+    """Drop buckets whose every bet has aged out of the window."""
+    cutoff = time.monotonic() - BET_RATE_LIMIT_WINDOW
+    with _rate_lock:
+        idle = [
+            uid for uid, bucket in _rate_buckets.items()
+            if not bucket or bucket[-1] <= cutoff
+        ]
+        for uid in idle:
+            del _rate_buckets[uid]
+    if idle:
+        log.info(f"Rate limiter: evicted {len(idle)} idle buckets.")
+
 # ─── HELPERS ──────────────────────────────────────────────────────────────────
 
 def ensure_user(conn, user):
-    conn.execute(
-        "INSERT OR IGNORE INTO users (telegram_id, username, coins) VALUES (?,?,0)",
-        (user.id, user.username or user.first_name),
-    )
-    # Keep username fresh
-    conn.execute(
-        "UPDATE users SET username=? WHERE telegram_id=?",
-        (user.username or user.first_name, user.id),
-    )
+    upsert_user(conn, user.id, user.username or user.first_name)
+
+# ─── MESSAGE TEMPLATES ────────────────────────────────────────────────────────
+# Built once at import; config constants are baked in, handlers only fill in
+# the per-call values.
+
+_EMOJI = {"UP": "📈", "DOWN": "📉"}
+
+_BET_OK_TEMPLATE = (
+    "{emoji} Bet placed: *{dir}* with *{amt:,}* coins.\n"
+    "If correct you'll win *{payout:,}* coins back.{close}\n"
+    "Balance: {bal:,} coins."
+)
+_CLOSES_IN_TEMPLATE = "\n⏱ Market resolves in ~{m}m {s}s."
+
+_BET_ERRORS = {
+    "no_market":    "⚠️ No active market right now. Try again shortly.",
+    "insufficient": "❌ Not enough coins. You have {coins:,} coins but tried to bet {amt:,}.",
+    "duplicate":    "⚠️ You already have a bet on this market. Wait for it to resolve.",
+    "closed":       "⚠️ This market just closed. Try again in a moment.",
+}
+
+_LEADERBOARD_HEADER = "🏆 *Weekly Leaderboard* (week of {week})\n"
+_LEADERBOARD_ROW    = "{medal} {username} — {coins:,} coins ({gain:+,} this week)"
+_RANK_LABELS        = ("🥇", "🥈", "🥉") + tuple(f"{i}." for i in range(4, 11))
+
+_DAILY_REWARD_TEMPLATE = (
+    f"🎉 Daily reward claimed! You received *{DAILY_REWARD_AMOUNT}* coins.\n"
+    "Balance: *{bal:,}* coins.\n\n"
+    "Use /bet UP 50 or /bet DOWN 50 to predict BTC!"
+)
 
 # ─── COMMAND HANDLERS ─────────────────────────────────────────────────────────
+# Blocking SQLite/HTTP work lives in sync _do_* helpers run via asyncio.to_thread,
+# so one slow handler never stalls the event loop for the others.
 
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    with _db_lock, get_conn() as conn:
+def _do_start(user):
+    with pool.write() as conn:
         ensure_user(conn, user)
+
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(_do_start, update.effective_user)
     await update.message.reply_text(
         "👋 Welcome to *CoinPredict*!\n\n"
         "React ❤️ to the pinned Daily Reward post to earn *100 coins* (once per day).\n"
@@ -266,22 +278,30 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown",
     )
 
-async def cmd_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    with _db_lock, get_conn() as conn:
+def _do_balance(user) -> int:
+    with pool.write() as conn:
         ensure_user(conn, user)
-        row = conn.execute(
+    with pool.read() as conn:
+        return conn.execute(
             "SELECT coins FROM users WHERE telegram_id=?", (user.id,)
-        ).fetchone()
-    await update.message.reply_text(f"💰 You have *{row['coins']:,}* coins.", parse_mode="Markdown")
+        ).fetchone()["coins"]
 
-async def cmd_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cmd_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    coins = await asyncio.to_thread(_do_balance, update.effective_user)
+    await update.message.reply_text(f"💰 You have *{coins:,}* coins.", parse_mode="Markdown")
+
+def _do_price() -> tuple[float | None, dict | None]:
     price = get_btc_price()
+    if price is None:
+        return None, None
+    with pool.read() as conn:
+        return price, get_cached_open_market(conn)
+
+async def cmd_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    price, market = await asyncio.to_thread(_do_price)
     if price is None:
         await update.message.reply_text("⚠️ Could not fetch BTC price right now. Try again shortly.")
         return
-    with _db_lock, get_conn() as conn:
-        market = get_open_market(conn)
     if market:
         change = price - market["open_price"]
         pct    = change / market["open_price"] * 100
@@ -294,6 +314,17 @@ async def cmd_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(f"₿ BTC is *${price:,.2f}*", parse_mode="Markdown")
 
+def _do_bet(user, direction_raw: str, amount: int) -> tuple[str | None, dict | None, int]:
+    """Place a bet; returns (error message or None, market, new balance)."""
+    with pool.write() as conn:
+        status, market, coins = place_bet_atomic(
+            conn, user.id, user.username or user.first_name, direction_raw, amount
+        )
+    error = _BET_ERRORS.get(status)
+    if status == "insufficient":
+        error = error.format(coins=coins, amt=amount)
+    return error, market, coins
+
 async def cmd_bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
 
@@ -329,102 +360,68 @@ async def cmd_bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Maximum bet is {MAX_BET_AMOUNT:,} coins.")
         return
 
-    with _db_lock, get_conn() as conn:
-        ensure_user(conn, user)
-
-        market = get_open_market(conn)
-        if not market:
-            await update.message.reply_text("⚠️ No active market right now. Try again shortly.")
-            return
-
-        row = conn.execute(
-            "SELECT coins FROM users WHERE telegram_id=?", (user.id,)
-        ).fetchone()
-        coins = row["coins"]
-
-        if amount > coins:
-            await update.message.reply_text(
-                f"❌ Not enough coins. You have {coins:,} coins but tried to bet {amount:,}."
-            )
-            return
-
-        # ── Duplicate bet check (UNIQUE constraint in DB also guards this)
-        existing = conn.execute(
-            "SELECT id FROM bets WHERE user_id=? AND market_id=? AND resolved=0",
-            (user.id, market["id"]),
-        ).fetchone()
-        if existing:
-            await update.message.reply_text(
-                "⚠️ You already have a bet on this market. Wait for it to resolve."
-            )
-            return
+    error, market, new_balance = await asyncio.to_thread(_do_bet, user, direction_raw, amount)
+    if error:
+        await update.message.reply_text(error)
+        return
 
-        # ── Place the bet
-        conn.execute(
-            "UPDATE users SET coins = coins - ? WHERE telegram_id=?",
-            (amount, user.id),
-        )
-        conn.execute(
-            "INSERT INTO bets (user_id, market_id, direction, amount) VALUES (?,?,?,?)",
-            (user.id, market["id"], direction_raw, amount),
-        )
+    remaining = market["close_time"] - int(time.time())
+    close_time_str = (
+        _CLOSES_IN_TEMPLATE.format(m=remaining // 60, s=remaining % 60) if remaining > 0 else ""
+    )
 
-        new_balance = coins - amount
-        close_time_str = ""
-        if market["open_time"]:
-            try:
-                open_dt   = datetime.fromisoformat(market["open_time"])
-                close_dt  = open_dt + timedelta(minutes=MARKET_INTERVAL_MINS)
-                remaining = int((close_dt - datetime.now(timezone.utc)).total_seconds())
-                if remaining > 0:
-                    close_time_str = f"\n⏱ Market resolves in ~{remaining // 60}m {remaining % 60}s."
-            except Exception:
-                pass
-
-    direction_emoji = "📈" if direction_raw == "UP" else "📉"
     await update.message.reply_text(
-        f"{direction_emoji} Bet placed: *{direction_raw}* with *{amount:,}* coins.\n"
-        f"If correct you'll win *{amount * WIN_MULTIPLIER:,}* coins back.{close_time_str}\n"
-        f"Balance: {new_balance:,} coins.",
+        _BET_OK_TEMPLATE.format(
+            emoji=_EMOJI[direction_raw],
+            dir=direction_raw,
+            amt=amount,
+            payout=amount * WIN_MULTIPLIER,
+            close=close_time_str,
+            bal=new_balance,
+        ),
         parse_mode="Markdown",
     )
 
 async def cmd_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    week_start = _current_week_start()
-    with _db_lock, get_conn() as conn:
-        # Compute weekly gain = current coins − coins_at_week_start (snapshot)
-        rows = conn.execute(
-            """
-            SELECT u.username,
-                   u.coins,
-                   u.coins - COALESCE(s.coins_at_week_start, 0) AS weekly_gain
-            FROM users u
-            LEFT JOIN weekly_coins_snapshot s
-                ON s.user_id = u.telegram_id AND s.week_start = ?
-            ORDER BY weekly_gain DESC, u.coins DESC
-            LIMIT 10
-            """,
-            (week_start,),
-        ).fetchall()
+    week_start = current_week_start()
+    rows = await asyncio.to_thread(load_leaderboard, week_start)
 
     if not rows:
         await update.message.reply_text("No players yet. Be the first!")
         return
 
-    medals = ["🥇", "🥈", "🥉"]
-    lines  = [f"🏆 *Weekly Leaderboard* (week of {week_start})\n"]
-    for i, row in enumerate(rows):
-        medal = medals[i] if i < 3 else f"{i+1}."
-        sign  = "+" if row["weekly_gain"] >= 0 else ""
-        lines.append(
-            f"{medal} {row['username']} — {row['coins']:,} coins "
-            f"({sign}{row['weekly_gain']:,} this week)"
-        )
-
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    text = "\n".join((
+        _LEADERBOARD_HEADER.format(week=week_start),
+        *(
+            _LEADERBOARD_ROW.format(
+                medal=label, username=row["username"], coins=row["coins"], gain=row["weekly_gain"]
+            )
+            for label, row in zip(_RANK_LABELS, rows)
+        ),
+    ))
+    await update.message.reply_text(text, parse_mode="Markdown")
 
 # ─── REACTION HANDLER (daily reward) ─────────────────────────────────────────
 
+def _do_daily_reward(user, today: str) -> int | None:
+    """Credit today's reward; returns the new balance, or None if already claimed."""
+    with pool.write() as conn:
+        ensure_user(conn, user)
+        row = conn.execute(
+            "SELECT last_daily FROM users WHERE telegram_id=?", (user.id,)
+        ).fetchone()
+
+        if row and row["last_daily"] == today:
+            return None
+
+        conn.execute(
+            "UPDATE users SET coins = coins + ?, last_daily = ? WHERE telegram_id=?",
+            (DAILY_REWARD_AMOUNT, today, user.id),
+        )
+        return conn.execute(
+            "SELECT coins FROM users WHERE telegram_id=?", (user.id,)
+        ).fetchone()["coins"]
+
 async def on_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Grant 100 coins when a user reacts to the pinned Daily Reward post."""
     reaction = update.message_reaction
@@ -441,49 +438,80 @@ async def on_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     today = datetime.now(timezone.utc).date().isoformat()
 
-    with _db_lock, get_conn() as conn:
-        ensure_user(conn, user)
-        row = conn.execute(
-            "SELECT last_daily FROM users WHERE telegram_id=?", (user.id,)
-        ).fetchone()
-
-        if row and row["last_daily"] == today:
-            # Already claimed — silently skip (no spam reply)
-            return
-
-        conn.execute(
-            "UPDATE users SET coins = coins + ?, last_daily = ? WHERE telegram_id=?",
-            (DAILY_REWARD_AMOUNT, today, user.id),
-        )
-        new_balance = conn.execute(
-            "SELECT coins FROM users WHERE telegram_id=?", (user.id,)
-        ).fetchone()["coins"]
+    new_balance = await asyncio.to_thread(_do_daily_reward, user, today)
+    if new_balance is None:
+        # Already claimed — silently skip (no spam reply)
+        return
 
     # Try to notify user privately; fall back to channel reply
     try:
         await context.bot.send_message(
             chat_id=user.id,
-            text=(
-                f"🎉 Daily reward claimed! You received *{DAILY_REWARD_AMOUNT}* coins.\n"
-                f"Balance: *{new_balance:,}* coins.\n\n"
-                f"Use /bet UP 50 or /bet DOWN 50 to predict BTC!"
-            ),
+            text=_DAILY_REWARD_TEMPLATE.format(bal=new_balance),
             parse_mode="Markdown",
         )
     except Exception:
         pass  # User hasn't started the bot; that's fine
 
+# ─── MINI APP API ─────────────────────────────────────────────────────────────
+
+def start_api_server():
+    """Serve server.py's Flask app on a background thread of this process.
+
+    Sharing the process means the API and the bot share one DB pool (a single
+    writer, so no cross-process SQLITE_BUSY) and the same in-memory caches.
+    waitress handles up to 8 requests at once, matching the read pool size.
+    """
+    port = int(os.environ.get("PORT", 5000))
+    threading.Thread(
+        target=serve,
+        args=(api_app,),
+        kwargs=dict(host="0.0.0.0", port=port, threads=8),
+        name="api",
+        daemon=True,
+    ).start()
+    log.info(f"Mini App API listening on :{port}")
+
+# ─── SCHEDULER ────────────────────────────────────────────────────────────────
+
+# Runs on PTB's event loop rather than a scheduler thread of its own.
+# Sync jobs are dispatched to the loop's default executor by APScheduler.
+scheduler = AsyncIOScheduler(timezone="UTC")
+
+async def _post_init(application):
+    scheduler.add_job(resolve_market,          "interval", minutes=MARKET_INTERVAL_MINS)
+    scheduler.add_job(refresh_weekly_snapshot, "cron",     day_of_week="mon", hour=0, minute=0)
+    scheduler.add_job(_gc_rate_buckets,        "interval", minutes=5)
+    scheduler.start()
+    log.info("Scheduler started.")
+
+async def _post_shutdown(application):
+    scheduler.shutdown(wait=False)
+
 # ─── MAIN ─────────────────────────────────────────────────────────────────────
 
 def main():
     init_db()
 
     # Open the first market on startup
-    with _db_lock, get_conn() as conn:
+    price = get_btc_price(force=True)
+    with pool.write() as conn:
         if not get_open_market(conn):
-            open_new_market(conn)
-
-    app = ApplicationBuilder().token(TOKEN).build()
+            open_new_market(conn, price)
+    invalidate_open_market()
+
+    start_api_server()
+
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        # Handlers offload DB/HTTP work to threads; let up to one update per
+        # pooled reader run at once instead of PTB's default of one at a time.
+        .concurrent_updates(READ_POOL_SIZE)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start",       cmd_start))
     app.add_handler(CommandHandler("balance",     cmd_balance))
@@ -492,12 +520,6 @@ def main():
     app.add_handler(CommandHandler("leaderboard", cmd_leaderboard))
     app.add_handler(MessageReactionHandler(on_reaction))
 
-    scheduler = BackgroundScheduler(timezone="UTC")
-    scheduler.add_job(resolve_market,          "interval", minutes=MARKET_INTERVAL_MINS)
-    scheduler.add_job(refresh_weekly_snapshot, "cron",     day_of_week="mon", hour=0, minute=0)
-    scheduler.start()
-    log.info("Scheduler started.")
-
     log.info("Bot polling…")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
@@ -0,0 +1,384 @@
+"""
+CoinPredict Shared Database Layer
+=================================
+Imported by bot.py and server.py, which run in the same process and so share
+one connection pool and one copy of every cache below.
+
+WAL mode lets any number of readers run alongside a single writer, so the
+pool keeps exactly one write connection (serialised by a lock) and a small
+queue of read connections. Connections are opened lazily, once, and reused
+for the lifetime of the process.
+
+Usage:
+    from db import pool
+    with pool.read() as conn:
+        conn.execute("SELECT ...")
+    with pool.write() as conn:      # commits on success, rolls back on error
+        conn.execute("UPDATE ...")
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+log = logging.getLogger(__name__)
+
+DB_PATH = "coinpredict.db"
+
+READ_POOL_SIZE = 8
+STATEMENT_CACHE_SIZE = 256  # per connection; the sqlite3 default is 128
+
+# Applied once per connection. synchronous=NORMAL is crash-safe under WAL and
+# does one fsync per commit instead of two; busy_timeout makes a writer wait
+# on a file locked by another process (e.g. `python server.py` during local
+# dev) instead of failing with SQLITE_BUSY.
+CONNECTION_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA busy_timeout=5000;
+    PRAGMA cache_size=-65536;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA foreign_keys=ON;
+"""
+
+
+class ConnectionPool:
+    """One writer connection plus up to `readers` reader connections."""
+
+    def __init__(self, path: str, readers: int = READ_POOL_SIZE):
+        self.path         = path
+        self._max_readers = readers
+        self._opened      = 0
+        self._open_lock   = threading.Lock()
+        self._readers     = queue.Queue()
+        self._writer      = None
+        self._write_lock  = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.executescript(CONNECTION_PRAGMAS)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._open_lock:
+            if self._opened < self._max_readers:
+                self._opened += 1
+                return self._connect()
+        return self._readers.get()  # pool exhausted: wait for a free reader
+
+    @contextmanager
+    def read(self):
+        """Borrow a reader connection for SELECTs."""
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        """Hold the single writer connection; commits on exit, rolls back on error."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            with self._writer:
+                yield self._writer
+
+
+pool = ConnectionPool(DB_PATH)
+
+# ─── SCHEMA ───────────────────────────────────────────────────────────────────
+
+SCHEMA_VERSION = 2  # PRAGMA user_version; bump alongside a step in _migrate()
+
+def _migrate(conn, version: int):
+    """Bring an existing database from `version` up to SCHEMA_VERSION."""
+    columns = {r["name"]: r["type"] for r in conn.execute("PRAGMA table_info(markets)")}
+    if version < 1 and columns["open_time"] == "TEXT":
+        # v1: ISO-8601 TEXT market times → INTEGER unix seconds (table rebuild)
+        conn.executescript("""
+            PRAGMA foreign_keys=OFF;
+            BEGIN;
+            CREATE TABLE markets_v1 (
+                id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                open_price    REAL    NOT NULL,
+                close_price   REAL,
+                open_time     INTEGER NOT NULL,
+                close_time    INTEGER,
+                status        TEXT    NOT NULL DEFAULT 'OPEN'
+            );
+            INSERT INTO markets_v1 (id, open_price, close_price, open_time, close_time, status)
+            SELECT id, open_price, close_price,
+                   CAST(strftime('%s', open_time) AS INTEGER),
+                   CAST(strftime('%s', close_time) AS INTEGER),
+                   status
+            FROM markets;
+            DROP TABLE markets;
+            ALTER TABLE markets_v1 RENAME TO markets;
+            COMMIT;
+            PRAGMA foreign_keys=ON;
+        """)
+        log.info("Migrated markets.open_time/close_time to unix seconds.")
+
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(bets)")}
+    if version < 2 and "outcome" not in columns:
+        # v2: materialise each bet's result instead of re-deriving it per request
+        conn.execute(
+            "ALTER TABLE bets ADD COLUMN outcome TEXT NOT NULL DEFAULT 'UNRESOLVED'"
+        )
+        conn.execute("""
+            UPDATE bets SET outcome = (
+                SELECT CASE
+                    WHEN abs(m.close_price - m.open_price) < 0.01 THEN 'TIE'
+                    WHEN (m.close_price > m.open_price) = (bets.direction = 'UP') THEN 'WIN'
+                    ELSE 'LOSS' END
+                FROM markets m WHERE m.id = bets.market_id
+            )
+            WHERE resolved = 1
+        """)
+        log.info("Migrated bets: added outcome column.")
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+def init_db():
+    with pool.write() as conn:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                telegram_id   INTEGER PRIMARY KEY,
+                username      TEXT,
+                coins         INTEGER NOT NULL DEFAULT 0,
+                last_daily    TEXT    -- ISO date YYYY-MM-DD UTC
+            );
+
+            CREATE TABLE IF NOT EXISTS markets (
+                id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                open_price    REAL    NOT NULL,
+                close_price   REAL,
+                open_time     INTEGER NOT NULL,  -- unix seconds
+                close_time    INTEGER,           -- unix seconds (scheduled, then actual)
+                status        TEXT    NOT NULL DEFAULT 'OPEN'  -- OPEN | CLOSED
+            );
+
+            CREATE TABLE IF NOT EXISTS bets (
+                id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id       INTEGER NOT NULL REFERENCES users(telegram_id),
+                market_id     INTEGER NOT NULL REFERENCES markets(id),
+                direction     TEXT    NOT NULL,  -- UP | DOWN
+                amount        INTEGER NOT NULL,
+                resolved      INTEGER NOT NULL DEFAULT 0,
+                outcome       TEXT    NOT NULL DEFAULT 'UNRESOLVED',  -- WIN | LOSS | TIE | UNRESOLVED
+                UNIQUE(user_id, market_id)       -- one bet per user per market
+            );
+
+            -- Weekly leaderboard snapshots (for display; actual coins never reset)
+            CREATE TABLE IF NOT EXISTS weekly_coins_snapshot (
+                user_id       INTEGER PRIMARY KEY REFERENCES users(telegram_id),
+                coins_at_week_start INTEGER NOT NULL DEFAULT 0,
+                week_start    TEXT    NOT NULL  -- ISO date of Monday
+            );
+        """)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            _migrate(conn, version)
+        conn.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_bets_market_resolved ON bets(market_id, resolved);
+            CREATE INDEX IF NOT EXISTS idx_bets_user_id_desc    ON bets(user_id, id DESC);
+            -- Partial index: only the (at most one) OPEN market lives in it
+            CREATE INDEX IF NOT EXISTS idx_markets_open         ON markets(id DESC) WHERE status='OPEN';
+            CREATE INDEX IF NOT EXISTS idx_users_coins_desc     ON users(coins DESC);
+        """)
+        conn.execute("ANALYZE")
+        ranks = compute_ranks(conn)
+    publish_ranks(ranks)
+    log.info("Database initialised.")
+
+# ─── USERS ────────────────────────────────────────────────────────────────────
+
+def upsert_user(conn, telegram_id: int, username: str):
+    # Single UPSERT; only rewrites the row when the username actually changed
+    conn.execute(
+        "INSERT INTO users (telegram_id, username, coins) VALUES (?,?,0) "
+        "ON CONFLICT(telegram_id) DO UPDATE SET username=excluded.username "
+        "WHERE users.username IS NOT excluded.username",
+        (telegram_id, username),
+    )
+
+# ─── OPEN MARKET ──────────────────────────────────────────────────────────────
+
+def get_open_market(conn):
+    return conn.execute(
+        "SELECT * FROM markets WHERE status='OPEN' ORDER BY id DESC LIMIT 1"
+    ).fetchone()
+
+# The open market only changes once per market interval, so callers share a
+# short-lived copy instead of querying it on every command/request.
+OPEN_MARKET_TTL = 2.0  # seconds
+
+_open_market_cache: tuple[dict | None, float] = (None, 0.0)
+_open_market_lock = threading.Lock()
+
+def get_cached_open_market(conn) -> dict | None:
+    global _open_market_cache
+    with _open_market_lock:
+        market, ts = _open_market_cache
+        if time.monotonic() - ts < OPEN_MARKET_TTL:
+            return market
+        row = get_open_market(conn)
+        market = dict(row) if row else None
+        _open_market_cache = (market, time.monotonic())
+        return market
+
+def invalidate_open_market():
+    global _open_market_cache
+    with _open_market_lock:
+        _open_market_cache = (None, 0.0)
+
+# ─── BETS ─────────────────────────────────────────────────────────────────────
+
+def place_bet_atomic(conn, user_id: int, username: str | None,
+                     direction: str, amount: int) -> tuple[str, dict | None, int | None]:
+    """Debit the stake and record the bet in one IMMEDIATE transaction.
+
+    `username` upserts the user first (pass None to require an existing user).
+    Returns (status, market, coins) where status is one of "ok", "no_market",
+    "no_user", "insufficient", "duplicate" or "closed"; coins is the new
+    balance on "ok" and the current balance on "insufficient".
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    if username is not None:
+        upsert_user(conn, user_id, username)
+
+    market = get_cached_open_market(conn)
+    if not market:
+        return "no_market", None, None
+
+    debited = conn.execute(
+        "UPDATE users SET coins = coins - ? WHERE telegram_id=? AND coins >= ? RETURNING coins",
+        (amount, user_id, amount),
+    ).fetchall()
+    if not debited:
+        row = conn.execute("SELECT coins FROM users WHERE telegram_id=?", (user_id,)).fetchone()
+        return ("insufficient", market, row["coins"]) if row else ("no_user", market, None)
+
+    try:
+        # The cached market may have been closed by resolve_market meanwhile
+        placed = conn.execute(
+            "INSERT INTO bets (user_id, market_id, direction, amount) "
+            "SELECT ?,?,?,? WHERE EXISTS "
+            "(SELECT 1 FROM markets WHERE id=? AND status='OPEN')",
+            (user_id, market["id"], direction, amount, market["id"]),
+        ).rowcount
+    except sqlite3.IntegrityError:  # UNIQUE(user_id, market_id)
+        conn.rollback()
+        return "duplicate", market, None
+    if not placed:
+        conn.rollback()
+        invalidate_open_market()
+        return "closed", market, None
+    return "ok", market, debited[0]["coins"]
+
+# ─── LEADERBOARD ──────────────────────────────────────────────────────────────
+
+# (value, expires): the Monday can only change at a UTC day boundary
+_week_cache: tuple[str | None, float] = (None, 0.0)
+
+def current_week_start() -> str:
+    """Return ISO date string of the most recent Monday (UTC)."""
+    global _week_cache
+    now = time.time()
+    value, expires = _week_cache
+    if now < expires:
+        return value
+    today = datetime.fromtimestamp(now, timezone.utc).date()
+    value = (today - timedelta(days=today.weekday())).isoformat()
+    _week_cache = (value, now - now % 86400 + 86400)  # next UTC midnight
+    return value
+
+# The top 10 only shifts meaningfully when a market resolves; serve it from
+# memory for a few seconds instead of re-running the JOIN on every request.
+LEADERBOARD_TTL = 10  # seconds
+
+# "gen" is bumped on every invalidation so a load that raced one is not stored
+_lb_cache = {"ts": 0.0, "rows": None, "week": None, "gen": 0}
+_lb_lock  = threading.Lock()
+
+def load_leaderboard(week_start: str) -> list[dict]:
+    """Top 10 users by weekly gain, cached for LEADERBOARD_TTL seconds."""
+    with _lb_lock:
+        if (_lb_cache["week"] == week_start
+                and time.monotonic() - _lb_cache["ts"] < LEADERBOARD_TTL):
+            return _lb_cache["rows"]
+        gen = _lb_cache["gen"]
+    with pool.read() as conn:
+        # Compute weekly gain = current coins − coins_at_week_start (snapshot)
+        rows = conn.execute(
+            """
+            SELECT u.telegram_id,
+                   u.username,
+                   u.coins,
+                   u.coins - COALESCE(s.coins_at_week_start, 0) AS weekly_gain
+            FROM users u
+            LEFT JOIN weekly_coins_snapshot s
+                ON s.user_id = u.telegram_id AND s.week_start = ?
+            ORDER BY weekly_gain DESC, u.coins DESC
+            LIMIT 10
+            """,
+            (week_start,),
+        ).fetchall()
+    rows = [dict(r) for r in rows]
+    with _lb_lock:
+        if _lb_cache["gen"] == gen:
+            _lb_cache.update(ts=time.monotonic(), rows=rows, week=week_start)
+    return rows
+
+def invalidate_leaderboard():
+    with _lb_lock:
+        _lb_cache["ts"] = 0.0
+        _lb_cache["gen"] += 1
+
+# ─── RANKS ────────────────────────────────────────────────────────────────────
+
+# Ranks of the top players, rebuilt once per market tick; anyone below that
+# falls back to a COUNT over idx_users_coins_desc.
+RANK_CACHE_SIZE = 1000
+
+_rank_cache: dict[int, int] = {}
+_rank_lock = threading.Lock()
+
+def compute_ranks(conn) -> dict[int, int]:
+    """Ranks of the top RANK_CACHE_SIZE users, as seen by `conn`."""
+    rows = conn.execute(
+        "SELECT telegram_id, RANK() OVER (ORDER BY coins DESC) AS rank "
+        "FROM users ORDER BY coins DESC LIMIT ?",
+        (RANK_CACHE_SIZE,),
+    ).fetchall()
+    return {r["telegram_id"]: r["rank"] for r in rows}
+
+def publish_ranks(ranks: dict[int, int]):
+    """Swap in ranks from compute_ranks(); call only once their txn has committed."""
+    global _rank_cache
+    with _rank_lock:
+        _rank_cache = ranks
+
+def user_rank(conn, telegram_id: int, coins: int) -> int:
+    """1 + number of users with more coins (ties share a rank)."""
+    with _rank_lock:
+        rank = _rank_cache.get(telegram_id)
+    if rank is not None:
+        return rank
+    return conn.execute(
+        "SELECT COUNT(*)+1 AS rank FROM users WHERE coins > ?", (coins,)
+    ).fetchone()["rank"]
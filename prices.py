@@ -0,0 +1,50 @@
+"""
+CoinPredict Price Feed
+======================
+BTC/USD from CoinGecko over a keep-alive session, with a short in-process
+cache shared by the bot and the Mini App API.
+"""
+
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+COINGECKO_URL = (
+    "https://api.coingecko.com/api/v3/simple/price"
+    "?ids=bitcoin&vs_currencies=usd"
+)
+
+# CoinGecko's own edge cache is ~20–30s, so polling faster only returns stale data
+PRICE_CACHE_TTL = 15  # seconds
+
+# Keep-alive session: reuses the TCP+TLS connection across fetches
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+_price_cache = {"ts": 0.0, "price": None}
+_price_lock  = threading.Lock()
+
+def get_btc_price(force: bool = False) -> float | None:
+    """Fetch BTC/USD from CoinGecko, cached for PRICE_CACHE_TTL seconds.
+    `force` skips the cache (market open/close needs a real tick). Returns None on failure."""
+    if not force:
+        with _price_lock:
+            if (_price_cache["price"] is not None
+                    and time.monotonic() - _price_cache["ts"] < PRICE_CACHE_TTL):
+                return _price_cache["price"]
+    try:
+        resp = _SESSION.get(COINGECKO_URL, timeout=10)
+        resp.raise_for_status()
+        price = float(resp.json()["bitcoin"]["usd"])
+        log.info(f"BTC price fetched: ${price:,.2f}")
+    except Exception as e:
+        log.error(f"CoinGecko error: {e}")
+        return None
+    with _price_lock:
+        _price_cache["ts"], _price_cache["price"] = time.monotonic(), price
+    return price